@@ -18,7 +18,8 @@ import fs from 'node:fs';
 import os from 'node:os';
 import path from 'node:path';
 import crypto from 'node:crypto';
-import { execSync } from 'node:child_process';
+import { execFile } from 'node:child_process';
+import { promisify } from 'node:util';
 import { Readable } from 'node:stream';
 import { pipeline } from 'node:stream/promises';
 import WebSocket from 'ws';
@@ -42,6 +43,10 @@ const AI_API_KEY = (() => {
 })();
 const AI_API_BASE_URL = process.env.AI_API_BASE_URL || 'https://api.openai.com/v1';
 
+// AI API 请求头只构建一次，各调用点共享
+const AI_AUTH_HEADERS = { 'Authorization': `Bearer ${AI_API_KEY}` };
+const AI_JSON_HEADERS = { ...AI_AUTH_HEADERS, 'Content-Type': 'application/json' };
+
 // 图片生成模型配置
 const IMAGE_GEN_MODEL = process.env.IMAGE_GEN_MODEL || 'dall-e-3';
 const IMAGE_GEN_SIZE = process.env.IMAGE_GEN_SIZE || '1024x1024';
@@ -73,6 +78,10 @@ function mustRead(filePath, label) {
 
 const uuid = () => crypto.randomUUID();
 
+// 异步执行外部命令，避免 ffmpeg/pdftotext 等阻塞事件循环；
+// 直接 exec 目标程序，不经过 /bin/sh，也不需要拼接转义路径
+const execFileAsync = promisify(execFile);
+
 // ============================================
 // 初始化检查
 // ============================================
@@ -132,14 +141,14 @@ function isDuplicate(messageId) {
 // Markdown 卡片构建
 // ============================================
 
+// 一次扫描同时处理 1~4 级标题和分隔线
+const CARD_REWRITE_RE = /^(?:#{1,4} (.+)|---)$/gm;
+
 function buildMarkdownCard(text) {
   // 飞书卡片不支持标准 Markdown 标题语法，转换为粗体
-  let processed = text
-    .replace(/^#### (.+)$/gm, '**$1**')
-    .replace(/^### (.+)$/gm, '**$1**')
-    .replace(/^## (.+)$/gm, '**$1**')
-    .replace(/^# (.+)$/gm, '**$1**')
-    .replace(/^---$/gm, '——————————');
+  const processed = text.replace(CARD_REWRITE_RE, (_, heading) =>
+    heading !== undefined ? `**${heading}**` : '——————————'
+  );
   
   const card = {
     "config": { "wide_screen_mode": true },
@@ -211,23 +220,21 @@ async function transcribeAudio(audioFile) {
   }
   
   try {
-    // 转换为 mp3 格式（Whisper 更好支持）
-    const mp3File = audioFile.replace(/\.\w+$/, '.mp3');
-    execSync(`ffmpeg -y -i "${audioFile}" -ar 16000 -ac 1 "${mp3File}"`, { timeout: 30000 });
+    // 转换为 mp3 格式（Whisper 更好支持），直接从 stdout 读取，不落临时文件
+    const { stdout: mp3 } = await execFileAsync(
+      'ffmpeg', ['-v', 'error', '-i', audioFile, '-ar', '16000', '-ac', '1', '-f', 'mp3', '-'],
+      { encoding: 'buffer', maxBuffer: 25 * 1024 * 1024, timeout: 30000 }
+    );
     
-    // 调用 Whisper API
-    const FormData = (await import('form-data')).default;
+    // 调用 Whisper API（使用 Node 内置 FormData，无需加载第三方模块）
     const form = new FormData();
-    form.append('file', fs.createReadStream(mp3File));
+    form.append('file', new Blob([mp3], { type: 'audio/mpeg' }), 'audio.mp3');
     form.append('model', 'whisper-1');
     form.append('language', 'zh');
     
     const response = await fetch(`${AI_API_BASE_URL}/audio/transcriptions`, {
       method: 'POST',
-      headers: {
-        'Authorization': `Bearer ${AI_API_KEY}`,
-        ...form.getHeaders()
-      },
+      headers: AI_AUTH_HEADERS,
       body: form
     });
     
@@ -235,7 +242,6 @@ async function transcribeAudio(audioFile) {
     
     // 清理临时文件
     try { fs.unlinkSync(audioFile); } catch {}
-    try { fs.unlinkSync(mp3File); } catch {}
     
     if (data?.text) {
       console.log(`[STT] Transcribed: ${data.text.slice(0, 50)}...`);
@@ -261,27 +267,27 @@ async function textToSpeech(text) {
     const truncatedText = text.slice(0, 4000);
     const tmpFile = path.join('/tmp', `tts_${Date.now()}.opus`);
     
-    const cmd = `curl -s -X POST "${AI_API_BASE_URL}/audio/speech" \
-      -H "Authorization: Bearer ${AI_API_KEY}" \
-      -H "Content-Type: application/json" \
-      -d '${JSON.stringify({
+    // 走 fetch 而非 curl 子进程，复用与其他 AI 接口相同的 keep-alive 连接池
+    const response = await fetch(`${AI_API_BASE_URL}/audio/speech`, {
+      method: 'POST',
+      headers: AI_JSON_HEADERS,
+      body: JSON.stringify({
         model: 'tts-1',
         input: truncatedText,
         voice: 'nova',
         response_format: 'opus'
-      }).replace(/'/g, "'\\''")}' \
-      --output "${tmpFile}"`;
-    
-    execSync(cmd, { timeout: 120000 });
-    
-    const stats = fs.statSync(tmpFile);
-    if (stats.size < 100) {
-      const content = fs.readFileSync(tmpFile, 'utf8');
-      console.error('[ERROR] TTS returned error:', content);
-      fs.unlinkSync(tmpFile);
+      }),
+      signal: AbortSignal.timeout(120000)
+    });
+
+    if (!response.ok || !response.body) {
+      console.error('[ERROR] TTS returned error:', response.status, await response.text().catch(() => ''));
       return null;
     }
-    
+
+    await pipeline(Readable.fromWeb(response.body), fs.createWriteStream(tmpFile));
+
+    const stats = fs.statSync(tmpFile);
     console.log(`[TTS] Generated: ${tmpFile} (${stats.size} bytes)`);
     return tmpFile;
   } catch (e) {
@@ -290,18 +296,51 @@ async function textToSpeech(text) {
   }
 }
 
+// Ogg Opus 时长 = (最后一页 granule position - pre-skip) / 48kHz，无需启动 ffprobe
+function readOggOpusDurationMs(audioFile) {
+  let fd;
+  try {
+    fd = fs.openSync(audioFile, 'r');
+    const { size } = fs.fstatSync(fd);
+    const head = Buffer.alloc(Math.min(size, 64));
+    fs.readSync(fd, head, 0, head.length, 0);
+    const opusHead = head.indexOf('OpusHead');
+    if (head.indexOf('OggS') !== 0 || opusHead < 0) return 0;
+    const preSkip = head.readUInt16LE(opusHead + 10);
+
+    const tailLen = Math.min(size, 65536);
+    const tail = Buffer.alloc(tailLen);
+    fs.readSync(fd, tail, 0, tailLen, size - tailLen);
+    const lastPage = tail.lastIndexOf('OggS');
+    if (lastPage < 0 || lastPage + 14 > tailLen) return 0;
+    const granule = Number(tail.readBigUInt64LE(lastPage + 6));
+    return granule > preSkip ? Math.round((granule - preSkip) / 48) : 0;
+  } catch {
+    return 0;
+  } finally {
+    if (fd !== undefined) try { fs.closeSync(fd); } catch {}
+  }
+}
+
 async function sendVoiceMessage(chatId, audioFile) {
   try {
     console.log(`[VOICE] Uploading audio: ${audioFile}`);
     
-    // 获取音频时长
-    let duration = 1000;
-    try {
-      const durationCmd = `ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "${audioFile}"`;
-      const durationStr = execSync(durationCmd, { encoding: 'utf8', timeout: 10000 }).trim();
-      duration = Math.round(parseFloat(durationStr) * 1000);
-    } catch (e) {
-      console.log('[VOICE] Could not get duration, using default');
+    // 获取音频时长（优先直接读 Ogg 容器，读不到再调用 ffprobe）
+    let duration = readOggOpusDurationMs(audioFile);
+    if (!duration) {
+      try {
+        const { stdout } = await execFileAsync(
+          'ffprobe',
+          ['-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audioFile],
+          { encoding: 'utf8', timeout: 10000 }
+        );
+        const durationStr = stdout.trim();
+        duration = Math.round(parseFloat(durationStr) * 1000);
+      } catch (e) {
+        console.log('[VOICE] Could not get duration, using default');
+        duration = 1000;
+      }
     }
     
     // 上传文件到飞书
@@ -379,9 +418,13 @@ async function downloadFeishuImage(messageId, imageKey) {
   }
 }
 
-function imageToBase64(imagePath) {
-  const imageBuffer = fs.readFileSync(imagePath);
-  return imageBuffer.toString('base64');
+// 根据文件头识别图片类型；下载的图片统一存成 .png，扩展名并不可靠
+function detectImageMime(buf) {
+  if (buf.length >= 8 && buf.readUInt32BE(0) === 0x89504e47) return 'image/png';
+  if (buf.length >= 3 && buf[0] === 0xff && buf[1] === 0xd8 && buf[2] === 0xff) return 'image/jpeg';
+  if (buf.length >= 6 && buf.toString('latin1', 0, 4) === 'GIF8') return 'image/gif';
+  if (buf.length >= 12 && buf.toString('latin1', 0, 4) === 'RIFF' && buf.toString('latin1', 8, 12) === 'WEBP') return 'image/webp';
+  return null;
 }
 
 async function analyzeImage(imagePath, userPrompt = '请描述这张图片') {
@@ -391,16 +434,16 @@ async function analyzeImage(imagePath, userPrompt = '请描述这张图片') {
   }
   
   try {
-    const base64Image = imageToBase64(imagePath);
+    // 读取一次，同时用于类型识别和 base64 编码
+    const imageBuffer = fs.readFileSync(imagePath);
+    const base64Image = imageBuffer.toString('base64');
     const ext = path.extname(imagePath).toLowerCase();
-    const mimeType = ext === '.png' ? 'image/png' : ext === '.gif' ? 'image/gif' : 'image/jpeg';
+    const mimeType = detectImageMime(imageBuffer)
+      || (ext === '.png' ? 'image/png' : ext === '.gif' ? 'image/gif' : 'image/jpeg');
     
     const response = await fetch(`${AI_API_BASE_URL}/chat/completions`, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': `Bearer ${AI_API_KEY}`
-      },
+      headers: AI_JSON_HEADERS,
       body: JSON.stringify({
         model: 'gpt-4o-mini',
         messages: [
@@ -439,10 +482,7 @@ async function generateImage(prompt) {
     
     const response = await fetch(`${AI_API_BASE_URL}/images/generations`, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': `Bearer ${AI_API_KEY}`
-      },
+      headers: AI_JSON_HEADERS,
       body: JSON.stringify({
         model: IMAGE_GEN_MODEL,
         prompt: prompt,
@@ -539,19 +579,45 @@ async function downloadFeishuFile(messageId, fileKey, fileName) {
   }
 }
 
+// 只读取文件开头足够容纳 maxChars 个字符的字节（UTF-8 每字符最多 4 字节），
+// 避免把整个大文件读进内存再截断
+function readTextHead(filePath, maxChars) {
+  const fd = fs.openSync(filePath, 'r');
+  try {
+    const buf = Buffer.alloc(maxChars * 4);
+    const bytesRead = fs.readSync(fd, buf, 0, buf.length, 0);
+    return buf.toString('utf8', 0, bytesRead).slice(0, maxChars);
+  } finally {
+    fs.closeSync(fd);
+  }
+}
+
+const TEXT_FILE_EXTS = ['.txt', '.md', '.json', '.js', '.py', '.sh', '.css', '.html', '.xml', '.csv'];
+const WORD_FILE_EXTS = ['.docx', '.doc'];
+
+function isExtractableFile(fileName) {
+  const ext = path.extname(fileName).toLowerCase();
+  return TEXT_FILE_EXTS.includes(ext) || ext === '.pdf' || WORD_FILE_EXTS.includes(ext);
+}
+
+function unsupportedFileText(fileName) {
+  return `[不支持的文件类型: ${path.extname(fileName).toLowerCase()}]`;
+}
+
 async function extractFileContent(filePath, fileName) {
   const ext = path.extname(fileName).toLowerCase();
   
   try {
     // 纯文本文件
-    if (['.txt', '.md', '.json', '.js', '.py', '.sh', '.css', '.html', '.xml', '.csv'].includes(ext)) {
-      return fs.readFileSync(filePath, 'utf8').slice(0, 10000);
+    if (TEXT_FILE_EXTS.includes(ext)) {
+      return readTextHead(filePath, 10000);
     }
     
     // PDF 文件
     if (ext === '.pdf') {
       try {
-        const text = execSync(`pdftotext -layout "${filePath}" -`, { encoding: 'utf8', maxBuffer: 10 * 1024 * 1024 });
+        // 只保留前 10000 字符，前 20 页足够，不必解析整本 PDF
+        const { stdout: text } = await execFileAsync('pdftotext', ['-layout', '-l', '20', filePath, '-'], { encoding: 'utf8', maxBuffer: 10 * 1024 * 1024 });
         return text.slice(0, 10000);
       } catch {
         return '[PDF 解析失败，请确保安装了 poppler-utils]';
@@ -559,16 +625,16 @@ async function extractFileContent(filePath, fileName) {
     }
     
     // Word 文档
-    if (['.docx', '.doc'].includes(ext)) {
+    if (WORD_FILE_EXTS.includes(ext)) {
       try {
-        const text = execSync(`pandoc "${filePath}" -t plain`, { encoding: 'utf8', maxBuffer: 10 * 1024 * 1024 });
+        const { stdout: text } = await execFileAsync('pandoc', [filePath, '-t', 'plain'], { encoding: 'utf8', maxBuffer: 10 * 1024 * 1024 });
         return text.slice(0, 10000);
       } catch {
         return '[Word 文档解析失败，请确保安装了 pandoc]';
       }
     }
     
-    return `[不支持的文件类型: ${ext}]`;
+    return unsupportedFileText(fileName);
   } catch (e) {
     console.error('[ERROR] Extract file content:', e?.message);
     return '[文件内容提取失败]';
@@ -629,16 +695,27 @@ async function sendFileMessage(chatId, filePath, fileName) {
 // 意图检测
 // ============================================
 
+const IMAGE_GEN_PATTERNS = [
+  /^(画|生成|创建|制作|绘制|设计|做).*(图|画|图片|图像|海报|插画)/,
+  /(图|画|图片|图像|海报|插画).*(画|生成|创建|制作|绘制)/,
+  /^画一/,
+  /generate\s*(an?\s+)?image/i,
+  /draw\s*(me\s+)?(a|an)?/i,
+  /create\s*(an?\s+)?picture/i
+];
+
+const FILE_SEND_PATTERNS = [
+  /^(发送|发|给我|传|上传).*(文件|报告|文档|pdf|pptx?|docx?|xlsx?)/i,
+  /(文件|报告|文档|pdf|pptx?|docx?|xlsx?).*(发送|发给|传给|给我)/i,
+  /^发送\s+\S+\.(pdf|pptx?|docx?|xlsx?|md)/i
+];
+
+const FILE_PATH_RE = /[~\/][^\s,，。！]+\.(pdf|pptx?|docx?|xlsx?|md)/i;
+const FILE_NAME_RE = /([^\s\/]+\.(pdf|pptx?|docx?|xlsx?|md))/i;
+const SENDABLE_EXT_RE = /\.(pdf|pptx?|docx?|xlsx?|md)$/i;
+
 function isImageGenerationRequest(text) {
-  const patterns = [
-    /^(画|生成|创建|制作|绘制|设计|做).*(图|画|图片|图像|海报|插画)/,
-    /(图|画|图片|图像|海报|插画).*(画|生成|创建|制作|绘制)/,
-    /^画一/,
-    /generate\s*(an?\s+)?image/i,
-    /draw\s*(me\s+)?(a|an)?/i,
-    /create\s*(an?\s+)?picture/i
-  ];
-  return patterns.some(p => p.test(text));
+  return IMAGE_GEN_PATTERNS.some(p => p.test(text));
 }
 
 function extractImagePrompt(text) {
@@ -649,24 +726,19 @@ function extractImagePrompt(text) {
 }
 
 function isFileSendRequest(text) {
-  const patterns = [
-    /^(发送|发|给我|传|上传).*(文件|报告|文档|pdf|pptx?|docx?|xlsx?)/i,
-    /(文件|报告|文档|pdf|pptx?|docx?|xlsx?).*(发送|发给|传给|给我)/i,
-    /^发送\s+\S+\.(pdf|pptx?|docx?|xlsx?|md)/i
-  ];
-  return patterns.some(p => p.test(text));
+  return FILE_SEND_PATTERNS.some(p => p.test(text));
 }
 
 function extractFilePath(text) {
   // 1. 匹配明确的文件路径
-  const pathMatch = text.match(/[~\/][^\s,，。！]+\.(pdf|pptx?|docx?|xlsx?|md)/i);
+  const pathMatch = text.match(FILE_PATH_RE);
   if (pathMatch) {
     const p = resolve(pathMatch[0]);
     if (fs.existsSync(p)) return p;
   }
   
   // 2. 匹配文件名，在多个目录查找
-  const nameMatch = text.match(/([^\s\/]+\.(pdf|pptx?|docx?|xlsx?|md))/i);
+  const nameMatch = text.match(FILE_NAME_RE);
   if (nameMatch) {
     for (const dir of FILE_SEARCH_PATHS) {
       const p = path.join(dir, nameMatch[1]);
@@ -681,10 +753,10 @@ function extractFilePath(text) {
   
   for (const dir of FILE_SEARCH_PATHS) {
     try {
-      if (!fs.existsSync(dir)) continue;
+      // 目录不存在时 readdirSync 会抛错，由 catch 跳过，无需额外 existsSync
       const files = fs.readdirSync(dir);
       for (const file of files) {
-        if (!/\.(pdf|pptx?|docx?|xlsx?|md)$/i.test(file)) continue;
+        if (!SENDABLE_EXT_RE.test(file)) continue;
         const filePath = path.join(dir, file);
         const stat = fs.statSync(filePath);
         if (stat.mtimeMs > thirtyMinutesAgo && stat.mtimeMs > newestTime) {
@@ -722,44 +794,128 @@ function shouldRespondInGroup(text, mentions = []) {
 // Clawdbot Gateway 通信
 // ============================================
 
-async function askClawdbot({ text, sessionKey }) {
-  return new Promise((resolve, reject) => {
-    const ws = new WebSocket(`ws://127.0.0.1:${GATEWAY_PORT}`);
-    let runId = null, buf = '';
+// 与 Gateway 保持一条长连接，所有会话复用，避免每条消息都重新建连和握手
+const GATEWAY_HANDSHAKE_TIMEOUT_MS = 15000;
+let gateway = null;              // 当前连接：{ ws, ready, connected, handshakeTimer, resolveReady, rejectReady }
+const pendingRuns = new Map();   // runId -> { buf, resolve, reject, timer, conn }
+
+function finishRun(runId, err) {
+  const run = pendingRuns.get(runId);
+  if (!run) return;
+  pendingRuns.delete(runId);
+  clearTimeout(run.timer);
+  if (err) run.reject(err);
+  else run.resolve(run.buf);
+}
+
+// 断开并丢弃一条连接：挂在该连接上的请求全部失败，下次请求重新建连
+function dropGateway(conn, err) {
+  if (gateway === conn) gateway = null;
+  clearTimeout(conn.handshakeTimer);
+  conn.rejectReady(err);
+  conn.ws.terminate();
+  for (const [runId, run] of pendingRuns) {
+    if (run.conn === conn) finishRun(runId, err);
+  }
+}
+
+function connectGateway() {
+  if (gateway) return gateway;
+  
+  const ws = new WebSocket(`ws://127.0.0.1:${GATEWAY_PORT}`);
+  const conn = { ws, connected: false };
+  conn.ready = new Promise((resolveReady, rejectReady) => {
+    conn.resolveReady = resolveReady;
+    conn.rejectReady = rejectReady;
+  });
+  conn.ready.catch(() => {});
+  gateway = conn;
+  
+  // 握手超时：Gateway 迟迟不发 challenge 或不回应 connect 时主动断开，避免连接永久卡死
+  conn.handshakeTimer = setTimeout(() => {
+    console.error('[GATEWAY] Handshake timeout');
+    dropGateway(conn, new Error('Gateway handshake timeout'));
+  }, GATEWAY_HANDSHAKE_TIMEOUT_MS);
+  
+  ws.on('error', (e) => { 
+    console.error('[GATEWAY] Connection error:', e?.message || e);
+    dropGateway(conn, e);
+  });
+  
+  ws.on('close', () => dropGateway(conn, new Error('Gateway connection closed')));
+  
+  ws.on('message', (raw) => {
+    let msg; 
+    try { msg = JSON.parse(raw.toString()); } catch { return; }
+    
+    // 连接握手
+    if (msg.type === 'event' && msg.event === 'connect.challenge') {
+      ws.send(JSON.stringify({ 
+        type: 'req', 
+        id: 'connect', 
+        method: 'connect', 
+        params: { 
+          minProtocol: 3, 
+          maxProtocol: 3, 
+          client: { id: 'gateway-client', version: '0.2.0', platform: 'linux', mode: 'backend' }, 
+          role: 'operator', 
+          scopes: ['operator.read', 'operator.write'], 
+          auth: { token: GATEWAY_TOKEN }, 
+          locale: 'zh-CN', 
+          userAgent: 'feishu-clawdbot-bridge' 
+        } 
+      }));
+      return;
+    }
     
-    const close = () => { try { ws.close(); } catch {} };
+    // 连接成功
+    if (msg.type === 'res' && msg.id === 'connect') {
+      clearTimeout(conn.handshakeTimer);
+      conn.connected = true;
+      conn.resolveReady();
+      return;
+    }
     
-    ws.on('error', (e) => { close(); reject(e); });
+    if (msg.type !== 'event') return;
+    const runId = msg.data?.runId;
+    const run = pendingRuns.get(runId);
+    if (!run) return;
     
-    ws.on('message', (raw) => {
-      let msg; 
-      try { msg = JSON.parse(raw.toString()); } catch { return; }
-      
-      // 连接握手
-      if (msg.type === 'event' && msg.event === 'connect.challenge') {
-        ws.send(JSON.stringify({ 
-          type: 'req', 
-          id: 'connect', 
-          method: 'connect', 
-          params: { 
-            minProtocol: 3, 
-            maxProtocol: 3, 
-            client: { id: 'gateway-client', version: '0.2.0', platform: 'linux', mode: 'backend' }, 
-            role: 'operator', 
-            scopes: ['operator.read', 'operator.write'], 
-            auth: { token: GATEWAY_TOKEN }, 
-            locale: 'zh-CN', 
-            userAgent: 'feishu-clawdbot-bridge' 
-          } 
-        }));
-        return;
-      }
-      
-      // 连接成功，发送消息
-      if (msg.type === 'res' && msg.id === 'connect') {
-        const rid = uuid();
-        runId = rid;
-        ws.send(JSON.stringify({ 
+    // 流式响应
+    if (msg.event === 'run.output.text') {
+      run.buf += msg.data.text || '';
+    }
+    
+    // 响应完成
+    if (msg.event === 'run.completed') {
+      finishRun(runId);
+    }
+    
+    // 响应失败
+    if (msg.event === 'run.failed') {
+      finishRun(runId, new Error(msg.data?.error || 'Run failed'));
+    }
+  });
+  
+  return conn;
+}
+
+async function askClawdbot({ text, sessionKey }) {
+  const rid = uuid();
+  const conn = connectGateway();
+  
+  return new Promise((resolve, reject) => {
+    // 超时处理（包含建连时间）；此时若握手仍未完成，一并断开这条连接
+    const timer = setTimeout(() => {
+      finishRun(rid, new Error('Timeout'));
+      if (!conn.connected) dropGateway(conn, new Error('Gateway handshake timeout'));
+    }, 120000);
+    pendingRuns.set(rid, { buf: '', resolve, reject, timer, conn });
+    
+    conn.ready.then(() => {
+      if (!pendingRuns.has(rid)) return;
+      try {
+        conn.ws.send(JSON.stringify({ 
           type: 'req', 
           id: rid, 
           method: 'messages.create', 
@@ -769,29 +925,10 @@ async function askClawdbot({ text, sessionKey }) {
             message: { role: 'user', content: text } 
           } 
         }));
-        return;
-      }
-      
-      // 流式响应
-      if (msg.type === 'event' && msg.event === 'run.output.text' && msg.data?.runId === runId) {
-        buf += msg.data.text || '';
-      }
-      
-      // 响应完成
-      if (msg.type === 'event' && msg.event === 'run.completed' && msg.data?.runId === runId) {
-        close();
-        resolve(buf);
-      }
-      
-      // 响应失败
-      if (msg.type === 'event' && msg.event === 'run.failed' && msg.data?.runId === runId) {
-        close();
-        reject(new Error(msg.data?.error || 'Run failed'));
+      } catch (e) {
+        finishRun(rid, e);
       }
-    });
-    
-    // 超时处理
-    setTimeout(() => { close(); reject(new Error('Timeout')); }, 120000);
+    }, (e) => finishRun(rid, e));
   });
 }
 
@@ -799,16 +936,34 @@ async function askClawdbot({ text, sessionKey }) {
 // 消息发送
 // ============================================
 
-async function sendReply(chatId, text) {
-  const msg = buildMessage(text);
+async function sendText(chatId, text) {
+  return client.im.v1.message.create({
+    params: { receive_id_type: 'chat_id' },
+    data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text }) }
+  });
+}
+
+// 提示消息与下载互不依赖，并发进行。两者都结束后再判断结果：
+// 提示发送失败时删除已下载的临时文件，并照旧把错误抛给调用方
+async function downloadWithNotice(chatId, notice, download) {
+  const [noticeRes, downloadRes] = await Promise.allSettled([sendText(chatId, notice), download]);
+  const tmpFile = downloadRes.status === 'fulfilled' ? downloadRes.value : null;
+  if (noticeRes.status === 'rejected') {
+    if (tmpFile) try { fs.unlinkSync(tmpFile); } catch {}
+    throw noticeRes.reason;
+  }
+  return tmpFile;
+}
+
+// msg 可由调用方传入已构建好的消息，避免重复转换和 JSON 序列化
+async function sendReply(chatId, text, msg = buildMessage(text)) {
   await client.im.v1.message.create({
     params: { receive_id_type: 'chat_id' },
     data: { receive_id: chatId, ...msg }
   });
 }
 
-async function updateReply(messageId, text) {
-  const msg = buildMessage(text);
+async function updateReply(messageId, text, msg = buildMessage(text)) {
   await client.im.v1.message.patch({
     path: { message_id: messageId },
     data: msg
@@ -851,29 +1006,24 @@ async function processMessage(event) {
       if (fileKey) {
         console.log(`[MSG] Received audio: ${fileKey}`);
         
-        await client.im.v1.message.create({
-          params: { receive_id_type: 'chat_id' },
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '🎤 正在识别语音...' }) }
-        });
+        // 未配置 AI_API_KEY 时无法识别，不必下载和转码
+        if (!AI_API_KEY) {
+          await sendText(chatId, '❌ 未配置 AI_API_KEY，暂不支持语音消息');
+          return;
+        }
         
-        const audioFile = await downloadFeishuAudio(messageId, fileKey);
+        const audioFile = await downloadWithNotice(chatId, '🎤 正在识别语音...', downloadFeishuAudio(messageId, fileKey));
         if (audioFile) {
           const transcribed = await transcribeAudio(audioFile);
           if (transcribed) {
             text = transcribed;
             console.log(`[STT] Transcribed: ${text}`);
           } else {
-            await client.im.v1.message.create({
-              params: { receive_id_type: 'chat_id' },
-              data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 语音识别失败，请重试或发送文字消息' }) }
-            });
+            await sendText(chatId, '❌ 语音识别失败，请重试或发送文字消息');
             return;
           }
         } else {
-          await client.im.v1.message.create({
-            params: { receive_id_type: 'chat_id' },
-            data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 语音下载失败，请重试' }) }
-          });
+          await sendText(chatId, '❌ 语音下载失败，请重试');
           return;
         }
       }
@@ -885,28 +1035,22 @@ async function processMessage(event) {
       if (imageKey) {
         console.log(`[MSG] Received image: ${imageKey}`);
         
-        await client.im.v1.message.create({
-          params: { receive_id_type: 'chat_id' },
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '🔍 正在分析图片...' }) }
-        });
+        if (!AI_API_KEY) {
+          await sendText(chatId, '❌ 未配置 AI_API_KEY，暂不支持图片消息');
+          return;
+        }
         
-        const imageFile = await downloadFeishuImage(messageId, imageKey);
+        const imageFile = await downloadWithNotice(chatId, '🔍 正在分析图片...', downloadFeishuImage(messageId, imageKey));
         if (imageFile) {
           const analysis = await analyzeImage(imageFile, '请详细描述这张图片的内容。如果有文字请识别出来。');
           if (analysis) {
             text = `[用户发送了图片]\n图片分析：${analysis}\n\n请基于分析结果回复。`;
           } else {
-            await client.im.v1.message.create({
-              params: { receive_id_type: 'chat_id' },
-              data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 图片分析失败' }) }
-            });
+            await sendText(chatId, '❌ 图片分析失败');
             return;
           }
         } else {
-          await client.im.v1.message.create({
-            params: { receive_id_type: 'chat_id' },
-            data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 图片下载失败' }) }
-          });
+          await sendText(chatId, '❌ 图片下载失败');
           return;
         }
       }
@@ -919,22 +1063,19 @@ async function processMessage(event) {
       if (fileKey) {
         console.log(`[MSG] Received file: ${fileName}`);
         
-        await client.im.v1.message.create({
-          params: { receive_id_type: 'chat_id' },
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '📄 正在处理文件...' }) }
-        });
-        
-        const filePath = await downloadFeishuFile(messageId, fileKey, fileName);
-        if (filePath) {
-          const fileText = await extractFileContent(filePath, fileName);
-          text = `[用户发送了文件: ${fileName}]\n内容摘要：${fileText.slice(0, 2000)}\n\n请基于内容回复。`;
+        let fileText;
+        if (isExtractableFile(fileName)) {
+          const filePath = await downloadWithNotice(chatId, '📄 正在处理文件...', downloadFeishuFile(messageId, fileKey, fileName));
+          if (!filePath) {
+            await sendText(chatId, '❌ 文件下载失败');
+            return;
+          }
+          fileText = await extractFileContent(filePath, fileName);
         } else {
-          await client.im.v1.message.create({
-            params: { receive_id_type: 'chat_id' },
-            data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 文件下载失败' }) }
-          });
-          return;
+          // 无法解析的类型（视频、压缩包等）不必先下载
+          fileText = unsupportedFileText(fileName);
         }
+        text = `[用户发送了文件: ${fileName}]\n内容摘要：${fileText.slice(0, 2000)}\n\n请基于内容回复。`;
       }
     }
     else {
@@ -950,10 +1091,7 @@ async function processMessage(event) {
       const prompt = extractImagePrompt(text);
       console.log(`[IMAGEGEN] Detected request: ${prompt}`);
       
-      await client.im.v1.message.create({
-        params: { receive_id_type: 'chat_id' },
-        data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '🎨 正在生成图片，请稍候...' }) }
-      });
+      await sendText(chatId, '🎨 正在生成图片，请稍候...');
       
       const imagePath = await generateImage(prompt);
       if (imagePath) {
@@ -961,10 +1099,7 @@ async function processMessage(event) {
         try { fs.unlinkSync(imagePath); } catch {}
         return;
       } else {
-        await client.im.v1.message.create({
-          params: { receive_id_type: 'chat_id' },
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 图片生成失败，请重试或换个描述' }) }
-        });
+        await sendText(chatId, '❌ 图片生成失败，请重试或换个描述');
         return;
       }
     }
@@ -972,22 +1107,17 @@ async function processMessage(event) {
     // 检测文件发送请求
     if (isFileSendRequest(text)) {
       const filePath = extractFilePath(text);
-      if (filePath && fs.existsSync(filePath)) {
+      // extractFilePath 只返回已确认存在的路径
+      if (filePath) {
         console.log(`[FILE] Detected send request: ${filePath}`);
         
-        await client.im.v1.message.create({
-          params: { receive_id_type: 'chat_id' },
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '📤 正在发送文件...' }) }
-        });
+        await sendText(chatId, '📤 正在发送文件...');
         
         const success = await sendFileMessage(chatId, filePath);
         if (success) {
           return;
         } else {
-          await client.im.v1.message.create({
-            params: { receive_id_type: 'chat_id' },
-            data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '❌ 文件发送失败' }) }
-          });
+          await sendText(chatId, '❌ 文件发送失败');
           return;
         }
       }
@@ -998,10 +1128,7 @@ async function processMessage(event) {
     const timer = THINKING_THRESHOLD_MS > 0 ? setTimeout(async () => {
       if (done) return;
       try { 
-        const res = await client.im.v1.message.create({ 
-          params: { receive_id_type: 'chat_id' }, 
-          data: { receive_id: chatId, msg_type: 'text', content: JSON.stringify({ text: '🤔 正在思考…' }) } 
-        }); 
+        const res = await sendText(chatId, '🤔 正在思考…'); 
         placeholderId = res?.data?.message_id || ''; 
       } catch {}
     }, THINKING_THRESHOLD_MS) : null;
@@ -1027,11 +1154,12 @@ async function processMessage(event) {
       return; 
     }
     
-    // 更新或发送回复
+    // 更新或发送回复（卡片只构建一次，更新失败时直接复用）
+    const replyMsg = buildMessage(reply);
     if (placeholderId) { 
-      try { await updateReply(placeholderId, reply); return; } catch {} 
+      try { await updateReply(placeholderId, reply, replyMsg); return; } catch {} 
     }
-    await sendReply(chatId, reply);
+    await sendReply(chatId, reply, replyMsg);
     
     // 语音回复（如果原消息是语音）
     if (messageType === 'audio' && reply.length < 500) {